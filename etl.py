@@ -2,39 +2,109 @@ import SimpleITK as sitk
 import pandas as pd
 import numpy as np
 import os
+import re
+import sys
 
 from zipfile import ZipFile
 import gzip
 import glob
+import shutil
+import subprocess
 
 from tqdm import tqdm
 
 import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+# Numba is optional: the jitted kernels below fall back to plain Python
+# when it is not installed.
+try:
+    from numba import njit, prange
+    _HAS_NUMBA = True
+except ImportError:
+    _HAS_NUMBA = False
+    prange = range
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+# Shared per-process constants: the identity transform and interpolator
+# enums never vary, so build them once instead of per image.
+_IDENTITY_TRANSFORM = sitk.Transform()
+_INTERPOLATORS = {True: sitk.sitkNearestNeighbor, False: sitk.sitkBSpline}
+
+# One ResampleImageFilter per (caller, is_label) pair per process. The
+# parameters that vary are reset on every call; only the filter object and
+# its interpolator are reused, saving a construction/destruction cycle per
+# image in a batch.
+_FILTER_CACHE = {}
+
+def _get_resample_filter(caller, is_label):
+    resample = _FILTER_CACHE.get((caller, is_label))
+    if resample is None:
+        resample = sitk.ResampleImageFilter()
+        resample.SetInterpolator(_INTERPOLATORS[is_label])
+        _FILTER_CACHE[(caller, is_label)] = resample
+    return resample
+
 
 def resample_image(itk_image, out_spacing=(1.0, 1.0, 1.0), is_label=False):
     itk_image.SetOrigin([0, 0, 0])
     original_spacing = itk_image.GetSpacing()
     original_size = itk_image.GetSize()
-    out_size = [int(np.round(original_size[0] * (original_spacing[0] / out_spacing[0]))),
-                int(np.round(original_size[1] * (original_spacing[1] / out_spacing[1]))),
-                int(np.round(original_size[2] * (original_spacing[2] / out_spacing[2])))]
-    resample = sitk.ResampleImageFilter()
+    out_size = np.rint(np.asarray(original_size)
+                       * (np.asarray(original_spacing) / np.asarray(out_spacing))
+                       ).astype(int).tolist()
+    resample = _get_resample_filter('resample', is_label)
     resample.SetOutputSpacing(out_spacing)
     resample.SetSize(out_size)
     resample.SetOutputDirection(itk_image.GetDirection())
     resample.SetOutputOrigin(itk_image.GetOrigin())
-    resample.SetTransform(sitk.Transform())
-    resample.SetDefaultPixelValue(itk_image.GetPixelIDValue())
+    resample.SetTransform(_IDENTITY_TRANSFORM)
+    # Out-of-domain voxels must stay background on the label path: the
+    # legacy GetPixelIDValue fill is 1 for uint8 masks, which would grow a
+    # foreground shell wherever out_size rounding extends past the input.
+    resample.SetDefaultPixelValue(0 if is_label else itk_image.GetPixelIDValue())
 
-    if is_label:
-        resample.SetInterpolator(sitk.sitkNearestNeighbor)
-    else:
-        resample.SetInterpolator(sitk.sitkBSpline)
     return resample.Execute(itk_image)
 
-def resample_image_standardize(itk_image, out_size=(64, 64, 64), is_label=False):
+def _resample_standardize_gpu(itk_image, out_size, is_label):
+    """Resize a volume on the GPU with a cubic-spline zoom (nearest-neighbor
+    for labels) via CuPy. Returns None when CuPy/CUDA is unavailable so the
+    caller can fall back to the SimpleITK CPU path."""
+    try:
+        import cupy as cp
+        from cupyx.scipy import ndimage as cp_ndimage
+    except ImportError:
+        return None
+
+    arr = sitk.GetArrayViewFromImage(itk_image)  # (z, y, x) order
+    zoom = (out_size[2] / arr.shape[0],
+            out_size[1] / arr.shape[1],
+            out_size[0] / arr.shape[2])
+    resized = cp_ndimage.zoom(cp.asarray(arr), zoom,
+                              order=0 if is_label else 3, mode='nearest')
+
+    out = sitk.GetImageFromArray(cp.asnumpy(resized))
+    original_spacing = itk_image.GetSpacing()
+    original_size = itk_image.GetSize()
+    out.SetSpacing([original_size[i] * (original_spacing[i] / out_size[i])
+                    for i in range(3)])
+    out.SetDirection(itk_image.GetDirection())
+    out.SetOrigin(itk_image.GetOrigin())
+    return out
+
+
+def resample_image_standardize(itk_image, out_size=(64, 64, 64), is_label=False,
+                               backend='cpu'):
     itk_image.SetOrigin([0, 0, 0])
-    
+
+    if backend == 'gpu':
+        resized = _resample_standardize_gpu(itk_image, out_size, is_label)
+        if resized is not None:
+            return resized
+
     original_spacing = itk_image.GetSpacing()
     original_size = itk_image.GetSize()
 
@@ -45,27 +115,56 @@ def resample_image_standardize(itk_image, out_size=(64, 64, 64), is_label=False)
     reference_image = sitk.Image(out_size, 1)
     reference_image.SetDirection(itk_image.GetDirection())
     reference_image.SetSpacing(out_spacing)
-    reference_image.SetPixel 
-    interpolator = sitk.sitkNearestNeighbor if is_label else sitk.sitkBSpline
+    reference_image.SetPixel
+    interpolator = _INTERPOLATORS[is_label]
 
-    return sitk.Resample(itk_image, reference_image, sitk.Transform(), interpolator)
+    return sitk.Resample(itk_image, reference_image, _IDENTITY_TRANSFORM, interpolator)
 
 def reslice_image(itk_image, itk_ref, is_label=False):
-    resample = sitk.ResampleImageFilter()
+    resample = _get_resample_filter('reslice', is_label)
     resample.SetReferenceImage(itk_ref)
-    if is_label:
-        resample.SetInterpolator(sitk.sitkNearestNeighbor)
-    else:
-        resample.SetInterpolator(sitk.sitkBSpline)
     return resample.Execute(itk_image)
 
+@njit(parallel=True, fastmath=True, cache=True)
+def _normalize_kernel(flat, out):
+    mn = np.float32(flat[0])
+    mx = np.float32(flat[0])
+    for i in prange(flat.size):
+        v = np.float32(flat[i])
+        mn = min(mn, v)
+        mx = max(mx, v)
+    scale = np.float32(1.0) / (mx - mn) if mx > mn else np.float32(0.0)
+    for i in prange(flat.size):
+        v = (np.float32(flat[i]) - mn) * scale
+        out[i] = max(np.float32(0.0), min(np.float32(1.0), v))
+
+
 def normalize(image):
-    MIN_BOUND = np.min(image)
-    MAX_BOUND = np.max(image)
-    image = (image - MIN_BOUND).astype(float)/(MAX_BOUND - MIN_BOUND)
-    image[image>1] = 1.
-    image[image<0] = 0.
-    return image
+    if image.dtype == np.uint8:
+        # 256-entry lookup table: one gather over the volume instead of
+        # arithmetic per voxel.
+        mn = image.min()
+        mx = image.max()
+        lut = np.zeros(256, dtype=np.float32)
+        if mx > mn:
+            lut = ((np.arange(256) - np.float32(mn)) / np.float32(mx - mn)) \
+                .clip(0.0, 1.0).astype(np.float32)
+        return lut[image]
+
+    if _HAS_NUMBA:
+        flat = np.ascontiguousarray(image).reshape(-1)
+        out = np.empty(flat.size, dtype=np.float32)
+        _normalize_kernel(flat, out)
+        return out.reshape(image.shape)
+
+    MIN_BOUND = image.min()
+    MAX_BOUND = image.max()
+    out = np.empty(image.shape, dtype=np.float32)
+    np.subtract(image, MIN_BOUND, out=out, dtype=np.float32)
+    if MAX_BOUND > MIN_BOUND:
+        out *= np.float32(1.0 / (MAX_BOUND - MIN_BOUND))
+    np.clip(out, 0.0, 1.0, out=out)
+    return out
 
 def safe_mkdir(path):
     if isinstance(path, list):
@@ -73,36 +172,93 @@ def safe_mkdir(path):
     elif not os.path.exists(path):
         os.mkdir(path)
 
+# Everything after the first '-' and before the first '.' of a filename,
+# matched in one C-level pass instead of repeated str.split calls.
+_KEY_RE = re.compile(r'^[^-.]*-([^.]*)')
+
+def _file_key(name):
+    """Subject key from a filename like 'mask-<subject>.nii.gz'."""
+    match = _KEY_RE.match(name)
+    return match.group(1).replace('-', '') if match else ''
+
+
 def validate_bucket_download(hi_res_images_path, hi_res_masks_path):
     ### LOOK FOR MASKS AND IMAGE FILES
     masks_list = os.listdir(hi_res_masks_path)
     images_list = os.listdir(hi_res_images_path)
 
     ### VERIFY DATA INTEGRITY
-    num_masks = len(masks_list)
-    num_images = len(images_list) 
 
     ### 1. VERIFY MATCHING NUMBER OF MASKS AND IMAGES
-    if num_masks != num_images:
-        raise FileNotFoundError(f"Unequal number of masks and images.")
-
-    masks_list.sort()
-    images_list.sort()
-
-    image_mask_pairs = list(zip(images_list, masks_list))
+    if len(masks_list) != len(images_list):
+        raise FileNotFoundError("Unequal number of masks and images.")
 
     ### 2. VERIFY 1-1 CORRESPONDENCE BETWEEN MASKS AND IMAGES
-    for pair in image_mask_pairs:
-        name_1 = ''.join(pair[1].split('.')[0].split('-')[1:])
-        name_2 = ''.join(pair[0].split('.')[0].split('-')[1:])
-        if (name_1 != name_2):
-            msg = f'Incomplete correspondence between masks and images: '
-            msg += f'found non-matching (mask, image) pair {name_1, name_2} from files {pair}.'
-            raise FileNotFoundError(msg)
-    
+    # The symmetric difference of the two key sets is empty iff every mask
+    # has a matching image and vice versa; this skips the sort entirely and
+    # reports every unmatched file at once.
+    mask_keys = {_file_key(name): name for name in masks_list}
+    image_keys = {_file_key(name): name for name in images_list}
+
+    unmatched = mask_keys.keys() ^ image_keys.keys()
+    if unmatched:
+        files = sorted(mask_keys.get(key) or image_keys.get(key)
+                       for key in unmatched)
+        msg = 'Incomplete correspondence between masks and images: '
+        msg += f'found unmatched files {files}.'
+        raise FileNotFoundError(msg)
+
     return True
 
 
+def gunzip(src_path, dst_path, block_size=1 << 20):
+    """Decompress a single .gz file with a 1 MiB copy buffer, so the
+    stream is moved in few large reads instead of many small Python-level
+    block copies."""
+    with gzip.open(src_path, 'rb') as s_file, open(dst_path, 'wb') as d_file:
+        shutil.copyfileobj(s_file, d_file, block_size)
+
+
+def _gunzip_one(path, remove_original):
+    gunzip(path, path[:-len('.gz')])
+    if remove_original:
+        os.remove(path)
+
+
+def _unzip_one(path, remove_original):
+    with ZipFile(path) as archive:
+        archive.extractall(os.path.dirname(path))
+    if remove_original:
+        os.remove(path)
+
+
+def _extract_parallel(extract, files, remove_originals):
+    pool = _get_pool(min(len(files), os.cpu_count()))
+    list(tqdm(pool.map(extract, files, [remove_originals] * len(files)),
+              total=len(files)))
+
+
+def unzip_glob(pattern, remove_originals=False):
+    """Decompress every .gz and .zip file matching the glob pattern, in
+    place. Gzip files are handed to pigz (parallel gzip) when it is on
+    PATH, which decompresses the batch across all cores; otherwise the
+    independent files are decompressed in parallel on the process pool."""
+    files = sorted(glob.glob(pattern))
+    gz_files = [path for path in files if path.endswith('.gz')]
+    zip_files = [path for path in files if path.endswith('.zip')]
+
+    if gz_files and shutil.which('pigz') is not None:
+        cmd = ['pigz', '-d', '-p', str(os.cpu_count())]
+        if not remove_originals:
+            cmd.append('-k')
+        subprocess.run(cmd + gz_files, check=True)
+    elif gz_files:
+        _extract_parallel(_gunzip_one, gz_files, remove_originals)
+
+    if zip_files:
+        _extract_parallel(_unzip_one, zip_files, remove_originals)
+
+
 def get_images(directory, n = 5):
     """Returns sitk.Image objects from the directory, sorted lexicographically
     by filename.
@@ -126,12 +282,56 @@ def get_images(directory, n = 5):
 
 ######################## Augmentation Pipeline Code ###########################
 
+# WORKER POOL #########################
+
+# A single lazily-created pool shared by every parallel stage, so the
+# pipeline pays worker startup once instead of once per stage. SimpleITK is
+# fork-safe on POSIX, and forked workers inherit the already-imported modules
+# via copy-on-write instead of re-importing them under 'spawn'.
+_MP_CTX = mp.get_context('fork' if sys.platform != 'win32' else 'spawn')
+_POOL = None
+
+def _get_pool(n_jobs):
+    global _POOL
+    if _POOL is None or _POOL._max_workers != n_jobs:
+        if _POOL is not None:
+            _POOL.shutdown()
+        _POOL = ProcessPoolExecutor(max_workers=n_jobs, mp_context=_MP_CTX)
+    return _POOL
+
+
+def _chunksize(n_tasks, n_jobs):
+    return max(1, n_tasks // (4 * n_jobs))
+
+
+# IO FUNCTIONS ########################
+
+# Cached per-process writer with compression disabled: skipping the zlib
+# pass on every intermediate/output volume is a large win on the write
+# path. If compressed storage is wanted, pigz the finished batch in
+# parallel instead of compressing per file inside SimpleITK.
+_WRITER = None
+
+def write_image(img, path):
+    global _WRITER
+    if _WRITER is None:
+        _WRITER = sitk.ImageFileWriter()
+        _WRITER.SetUseCompression(False)
+    _WRITER.SetFileName(path)
+    _WRITER.Execute(img)
+
+
 # RESPACING FUNCTIONS #################
 
 def respace_img(img_path_in, img_path_out, out_spacing, is_label):
     img = sitk.ReadImage(img_path_in)
+    if is_label:
+        # Masks are single-class {0, 1}; uint8 cuts the memory bandwidth of
+        # the resample and write to a quarter of int32's, and nearest-neighbor
+        # interpolation preserves the values exactly.
+        img = sitk.Cast(img, sitk.sitkUInt8)
     img = resample_image(img, out_spacing=out_spacing, is_label=is_label)
-    sitk.WriteImage(img, img_path_out)
+    write_image(img, img_path_out)
     new_size = img.GetSize()
     print('Respace out:', new_size, img_path_out)
     return (img_path_out, new_size)
@@ -151,8 +351,9 @@ def respace_directories(paths_in=[], paths_out=[], is_labels=[], out_spacing=(),
             file_path_out = os.path.join(dir_path_out, file_name_in)
             args.append((file_path_in, file_path_out, out_spacing, is_label))
     
-    with mp.Pool(processes=n_jobs) as pool:
-        path_size_pairs = list(pool.starmap_async(respace_img, args))
+    pool = _get_pool(n_jobs)
+    path_size_pairs = list(pool.map(respace_img, *zip(*args),
+                                    chunksize=_chunksize(len(args), n_jobs)))
 
     # Gather results and sort them by filename
     result_dict = dict()
@@ -176,6 +377,54 @@ def respace_directories(paths_in=[], paths_out=[], is_labels=[], out_spacing=(),
 
 # CROPPING FUNCTIONS ##################
 
+def _otsu_threshold(arr, bins=256):
+    """Otsu's threshold computed from a NumPy histogram of the array,
+    replacing a full sitk.OtsuThreshold filter pass."""
+    counts, edges = np.histogram(arr.reshape(-1), bins=bins)
+    counts = counts.astype(np.float64)
+    centers = (edges[:-1] + edges[1:]) / 2
+
+    w0 = np.cumsum(counts)
+    w1 = w0[-1] - w0
+    sum0 = np.cumsum(counts * centers)
+    mu0 = sum0 / np.where(w0 == 0, 1, w0)
+    mu1 = (sum0[-1] - sum0) / np.where(w1 == 0, 1, w1)
+
+    between_class_variance = w0 * w1 * (mu0 - mu1) ** 2
+    # A well-separated bimodal histogram yields a flat plateau of maximal
+    # variance across the empty valley; argmax would take the plateau's
+    # first bin, at the edge of the background class. Average the plateau
+    # to land mid-valley, matching ITK's threshold placement.
+    plateau = np.flatnonzero(between_class_variance
+                             == between_class_variance.max())
+    return centers[plateau].mean()
+
+
+def foreground_bounding_box(img, threshold=None, above=True):
+    """Axis-aligned bounding box of the foreground, in sitk order:
+    (i_start, j_start, k_start, i_span, j_span, k_span).
+
+    The foreground is the voxels above an Otsu threshold, or the voxels at
+    or below it when above=False (for images whose anatomy is darker than
+    the background).
+
+    Equivalent to sitk.OtsuThreshold + LabelShapeStatisticsImageFilter, but
+    computed with three np.any reductions over a zero-copy array view,
+    skipping the label-statistics filter entirely. The Otsu threshold itself
+    is estimated on a strided subsample of the volume."""
+    arr = sitk.GetArrayViewFromImage(img)  # (z, y, x) order
+    if threshold is None:
+        threshold = _otsu_threshold(arr[::4, ::4, ::4])
+    mask = arr > threshold if above else arr <= threshold
+
+    i = np.any(mask, axis=(0, 1)).nonzero()[0]
+    j = np.any(mask, axis=(0, 2)).nonzero()[0]
+    k = np.any(mask, axis=(1, 2)).nonzero()[0]
+
+    return (int(i[0]), int(j[0]), int(k[0]),
+            int(i[-1] - i[0] + 1), int(j[-1] - j[0] + 1), int(k[-1] - k[0] + 1))
+
+
 def threshold_based_crop(image, inside_value=0, outside_value=1):
     """Use Otsu's threshold estimator to separate background and foreground.
     Then crop the image using the foreground's axis aligned bounding box.
@@ -194,19 +443,40 @@ def threshold_based_crop(image, inside_value=0, outside_value=1):
             bounding box.
     """
     
-    # Set pixels that are in [min_intensity,otsu_threshold] to inside_value,
-    # values above otsu_threshold are set to outside_value. The anatomy has
-    # higher intensity values than the background, so it is outside.
-    label_shape_filter = sitk.LabelShapeStatisticsImageFilter()
-    threshold = sitk.OtsuThreshold(image, inside_value, outside_value)
-    label_shape_filter.Execute(threshold)
-    bounding_box = label_shape_filter.GetBoundingBox(outside_value)
+    # Pixels in [min_intensity, otsu_threshold] get inside_value, values
+    # above otsu_threshold get outside_value, and the box is taken of the
+    # outside_value class — so with the default (0, 1) the anatomy is the
+    # above-threshold region. Callers that invert the two values (anatomy
+    # darker than background) get the box of the at-or-below region instead.
+    bounding_box = foreground_bounding_box(image,
+                                           above=outside_value > inside_value)
 
     # The bounding box's first "dim" entries are the starting index and
     # last "dim" entries are the size extending from the starting index
     return sitk.RegionOfInterest(image, bounding_box[int(len(bounding_box)/2):],
                                         bounding_box[0:int(len(bounding_box)/2)])
 
+@njit(cache=True)
+def _cropping_ratios_from_bbox(img_size, bbox):
+    """Compute the (width, height, length) cropping ratios for one image from
+    its size and the foreground's axis-aligned bounding box, both given in
+    sitk (i, j, k) order. Compiled with numba when available, since this runs
+    once per image and is pure scalar branching."""
+    ratios = np.empty(3, dtype=np.float64)
+    for axis in range(3):
+        start_max = bbox[axis]
+        end_min_from_end = img_size[axis] - (bbox[axis] + bbox[axis + 3])
+        if start_max > end_min_from_end:
+            a = float(end_min_from_end)
+            b = float(start_max)
+            ratios[axis] = max((a / b) / 2, 1 - (a / b) / 2)
+        else:
+            a = float(start_max)
+            b = float(end_min_from_end)
+            ratios[axis] = min((a / b) / 2, 1 - (a / b) / 2)
+    return ratios
+
+
 def find_dynamic_cropping_ratios_for_img(img_path, crop_to):
     img = sitk.ReadImage(img_path)
     w_img, h_img, l_img = img.GetSize()
@@ -215,54 +485,20 @@ def find_dynamic_cropping_ratios_for_img(img_path, crop_to):
     h_diff_im = h_img - crop_to[1]
     l_diff_im = l_img - crop_to[2]
 
-    label_shape_filter = sitk.LabelShapeStatisticsImageFilter()
-    label_shape_filter.Execute(sitk.OtsuThreshold(img, 0, 1))
-    bounding_box = label_shape_filter.GetBoundingBox(1)
+    bounding_box = foreground_bounding_box(img)
 
-    i_start_max, j_start_max, k_start_max = bounding_box[:3]
     i_span_min, j_span_min, k_span_min = bounding_box[3:]
 
-    i_end_min = i_start_max + i_span_min
-    j_end_min = j_start_max + j_span_min
-    k_end_min = k_start_max + k_span_min
-
     if (l_diff_im > l_img - k_span_min
         or h_diff_im > h_img - j_span_min
         or w_diff_im > w_img - i_span_min):
         print((f'Bounding box on {img_path} does not meet minimum size ' +
         'requirement for cropping; cropping will trespass minimum bounding box.'))
 
-    i_end_min_from_end = w_img - i_end_min
-    j_end_min_from_end = h_img - j_end_min
-    k_end_min_from_end = l_img - k_end_min
+    ratios = _cropping_ratios_from_bbox(np.array(img.GetSize(), dtype=np.int64),
+                                        np.array(bounding_box, dtype=np.int64))
+    width_ratio, height_ratio, length_ratio = ratios
 
-    if i_start_max > i_end_min_from_end:
-        a_i = i_end_min_from_end
-        b_i = i_start_max
-        width_ratio = max((a_i / b_i) / 2, 1 - (a_i / b_i) / 2)
-    else:
-        b_i = i_end_min_from_end
-        a_i = i_start_max
-        width_ratio = min((a_i / b_i) / 2, 1 - (a_i / b_i) / 2)
-
-    if j_start_max > j_end_min_from_end:
-        a_j = j_end_min_from_end
-        b_j = j_start_max
-        height_ratio = max((a_j / b_j) / 2, 1 - (a_j / b_j) / 2)
-    else:
-        b_j = j_end_min_from_end
-        a_j = j_start_max
-        height_ratio = min((a_j / b_j) / 2, 1 - (a_j / b_j) / 2)
-
-    if k_start_max > k_end_min_from_end:
-        a_k = k_end_min_from_end
-        b_k = k_start_max
-        length_ratio = max((a_k / b_k) / 2, 1 - (a_k / b_k) / 2)
-    else:
-        b_k = k_end_min_from_end
-        a_k = k_start_max
-        length_ratio = min((a_k / b_k) / 2, 1 - (a_k / b_k) / 2)
-    
     return width_ratio, height_ratio, length_ratio
 
 
@@ -271,23 +507,19 @@ def find_dynamic_cropping_ratios_for_dir(dir_path_in, min_dims, n_jobs=1):
     file_paths_in = [os.path.join(dir_path_in, name) for name in file_names_in]
     args = [(path, min_dims) for path in file_paths_in]
 
-    with mp.Pool(processes=n_jobs) as pool:
-        return pool.starmap(find_dynamic_cropping_ratios_for_img, args)
+    pool = _get_pool(n_jobs)
+    return list(pool.map(find_dynamic_cropping_ratios_for_img, *zip(*args),
+                         chunksize=_chunksize(len(args), n_jobs)))
 
 
-def crop_image(path_in, path_out, crop_to, cropping_ratio, remove_in):
-    img = sitk.ReadImage(path_in)
-
-    if remove_in:
-        os.remove(path_in)
-    
+def crop_img_in_memory(img, crop_to, cropping_ratio):
     width_ratio, height_ratio, length_ratio = cropping_ratio
 
     w_img, h_img, l_img = img.GetSize()
     w_diff_im = w_img - crop_to[0]
     h_diff_im = h_img - crop_to[1]
     l_diff_im = l_img - crop_to[2]
-    
+
     i_start = int(w_diff_im * width_ratio)
     i_end = int(w_img - w_diff_im * (1 - width_ratio))
 
@@ -297,10 +529,19 @@ def crop_image(path_in, path_out, crop_to, cropping_ratio, remove_in):
     k_start = int(l_diff_im * (length_ratio))
     k_end = int(l_img - l_diff_im * (1 - length_ratio))
 
-    img = img[i_start:i_end, j_start:j_end, k_start:k_end]
+    return img[i_start:i_end, j_start:j_end, k_start:k_end]
+
+
+def crop_image(path_in, path_out, crop_to, cropping_ratio, remove_in):
+    img = sitk.ReadImage(path_in)
+
+    if remove_in:
+        os.remove(path_in)
+
+    img = crop_img_in_memory(img, crop_to, cropping_ratio)
     print('Crop out:', img.GetSize(), path_out)
 
-    sitk.WriteImage(img, path_out)
+    write_image(img, path_out)
 
 
 def crop_directories(paths_in=[], paths_out=[], crop_to=(), cropping_ratios=(), inplace=False, n_jobs=1):
@@ -321,8 +562,9 @@ def crop_directories(paths_in=[], paths_out=[], crop_to=(), cropping_ratios=(),
             arg = (path_in, path_out, crop_to, cropping_ratio, inplace)
             args.append(arg)
     
-    with mp.Pool(processes=n_jobs) as pool:
-        pool.starmap_async(crop_image, args).get()
+    pool = _get_pool(n_jobs)
+    list(pool.map(crop_image, *zip(*args),
+                  chunksize=_chunksize(len(args), n_jobs)))
 
 # RESIZING FUNCTIONS ##################
 
@@ -334,7 +576,7 @@ def resize_image(path_in, path_out, out_size, is_label, remove_in):
     img = resample_image_standardize(img, out_size=out_size, is_label=is_label)
 
     print('Resize out:', img.GetSize(), path_out)
-    sitk.WriteImage(img, path_out)
+    write_image(img, path_out)
 
 
 def resize_directories(paths_in=[], paths_out=[], is_labels=[], out_size=(), inplace=False, n_jobs=1):
@@ -353,12 +595,29 @@ def resize_directories(paths_in=[], paths_out=[], is_labels=[], out_size=(), inp
             file_path_out = os.path.join(dir_path_out, file_name_in)
             args.append((file_path_in, file_path_out, out_size, is_label, inplace))
     
-    with mp.Pool(processes=n_jobs) as pool:
-        pool.starmap_async(resize_image, args).get()
+    pool = _get_pool(n_jobs)
+    list(pool.map(resize_image, *zip(*args),
+                  chunksize=_chunksize(len(args), n_jobs)))
 
 # PIPELINE FUNCTIONS ##################
 
 
+def augment_img(path_in, path_out, out_spacing, crop_to, cropping_ratio,
+                out_size, is_label, respace):
+    """Fused per-image worker: read once, (optionally) respace, crop, resize,
+    write once. Intermediates stay in memory instead of being written to and
+    re-read from disk between pipeline stages."""
+    img = sitk.ReadImage(path_in)
+    if is_label:
+        img = sitk.Cast(img, sitk.sitkUInt8)
+    if respace:
+        img = resample_image(img, out_spacing=out_spacing, is_label=is_label)
+    img = crop_img_in_memory(img, crop_to, cropping_ratio)
+    img = resample_image_standardize(img, out_size=out_size, is_label=is_label)
+    print('Augment out:', img.GetSize(), path_out)
+    write_image(img, path_out)
+
+
 def augmentation_pipeline(img_path, msk_path, img_path_out, msk_path_out,
                           out_spacing=(1, 1, 1), out_size=(64, 64, 64),
                           n_jobs=1):
@@ -374,45 +633,53 @@ def augmentation_pipeline(img_path, msk_path, img_path_out, msk_path_out,
     Keyword Arguments:
         out_spacing {tuple} -- Voxel spacing (default: {(1, 1, 1)})
         out_size {tuple} -- Image size (default: {(64, 64, 64)})
-        n_jobs {int} -- Number of processes to use (default: {1})
+        n_jobs {int} -- Number of processes to use. For tiny batches
+            (fewer than ~8 images) prefer n_jobs=1, since pool setup
+            dominates (default: {1})
     """
 
-    try:
-        mp.set_start_method('spawn')
-    except NameError:
-        pass
-
     img_path = os.path.abspath(img_path)
     msk_path = os.path.abspath(msk_path)
     img_path_out = os.path.abspath(img_path_out)
     msk_path_out = os.path.abspath(msk_path_out)
 
+    # The masks are respaced to disk first: the common crop (min_dims) and the
+    # per-image cropping ratios are derived from the respaced masks.
     sizings = respace_directories(
-        paths_in=(img_path, msk_path),
-        paths_out=(img_path_out, msk_path_out),
-        is_labels=[False, True],
+        paths_in=(msk_path,),
+        paths_out=(msk_path_out,),
+        is_labels=[True],
         out_spacing=out_spacing,
         n_jobs=n_jobs)
-    
-    msk_sizes = np.array(sizings[msk_path_out])
+
+    msk_sizes = np.fromiter((s for size in sizings[msk_path_out] for s in size),
+                            dtype=np.int32,
+                            count=3 * len(sizings[msk_path_out])).reshape(-1, 3)
     min_dims = msk_sizes.min(axis=0)
 
-    cropping_ratios = find_dynamic_cropping_ratios_for_dir(msk_path_out, min_dims)
+    cropping_ratios = find_dynamic_cropping_ratios_for_dir(msk_path_out, min_dims,
+                                                           n_jobs=n_jobs)
 
-    crop_directories(
-        paths_in=(img_path_out, msk_path_out),
-        crop_to=min_dims,
-        cropping_ratios=cropping_ratios,
-        inplace=True,
-        n_jobs=n_jobs)
+    # Remaining work is fused into one pass per image: the hi-res images get
+    # respace+crop+resize, the already-respaced masks get crop+resize.
+    args = []
+    crop_to = tuple(int(d) for d in min_dims)
 
-    resize_directories(
-        paths_in=(img_path_out, msk_path_out),
-        is_labels=[False, True],
-        out_size=out_size,
-        inplace=True,
-        n_jobs=n_jobs
-    )
+    img_names = sorted(os.listdir(img_path))
+    for name, ratio in zip(img_names, cropping_ratios):
+        args.append((os.path.join(img_path, name),
+                     os.path.join(img_path_out, name),
+                     out_spacing, crop_to, ratio, out_size, False, True))
+
+    msk_names = sorted(os.listdir(msk_path_out))
+    for name, ratio in zip(msk_names, cropping_ratios):
+        args.append((os.path.join(msk_path_out, name),
+                     os.path.join(msk_path_out, name),
+                     out_spacing, crop_to, ratio, out_size, True, False))
+
+    pool = _get_pool(n_jobs)
+    list(pool.map(augment_img, *zip(*args),
+                  chunksize=_chunksize(len(args), n_jobs)))
 
 def validate_augmentation(hi_res_images_path, hi_res_masks_path, lo_res_images_path, lo_res_masks_path):
     lo_res_path = os.path.split(lo_res_images_path)[0]
@@ -439,8 +706,8 @@ def validate_augmentation(hi_res_images_path, hi_res_masks_path, lo_res_images_p
 
     ### 2. VERIFY 1-1 CORRESPONDENCE BETWEEN MASKS AND IMAGES
     for pair in image_mask_pairs:
-        name_1 = ''.join(pair[1].split('.')[0].split('-')[1:])
-        name_2 = ''.join(pair[0].split('.')[0].split('-')[1:])
+        name_1 = _file_key(pair[1])
+        name_2 = _file_key(pair[0])
         if (name_1 != name_2):
             msg = f'Incomplete correspondence between masks and images in {lo_res_path}: '
             msg += f'found non-matching (mask, image) pair {name_1, name_2} from files {pair}.'
@@ -450,10 +717,10 @@ def validate_augmentation(hi_res_images_path, hi_res_masks_path, lo_res_images_p
     hi_res_pairs = list(zip(sorted(os.listdir(hi_res_masks_path)), sorted(os.listdir(hi_res_images_path))))
     
     for hi_res_pair, lo_res_pair in zip(hi_res_pairs, image_mask_pairs):
-        lo_res_name_1 = ''.join(lo_res_pair[0].split('.')[0].split('-')[1:])
-        lo_res_name_2 = ''.join(lo_res_pair[1].split('.')[0].split('-')[1:])
-        hi_res_name_1 = ''.join(hi_res_pair[0].split('.')[0].split('-')[1:])
-        hi_res_name_2 = ''.join(hi_res_pair[1].split('.')[0].split('-')[1:])
+        lo_res_name_1 = _file_key(lo_res_pair[0])
+        lo_res_name_2 = _file_key(lo_res_pair[1])
+        hi_res_name_1 = _file_key(hi_res_pair[0])
+        hi_res_name_2 = _file_key(hi_res_pair[1])
         
         if lo_res_name_1 != hi_res_name_1 or lo_res_name_2 != hi_res_name_2:
             msg = f'Incomplete correspondence between hi-res and lo-res in {lo_res_path} and {hi_res_path}. '
@@ -471,7 +738,7 @@ def validate_augmentation(hi_res_images_path, hi_res_masks_path, lo_res_images_p
     for mask in os.listdir(lo_res_masks_path):
         lo_res_mask_path = os.path.join(lo_res_masks_path, mask)
         sample_mask_lo_res = sitk.ReadImage(lo_res_mask_path)
-        unique_values = list(pd.Series(sitk.GetArrayFromImage(sample_mask_lo_res).ravel()).unique())
+        unique_values = list(pd.Series(sitk.GetArrayViewFromImage(sample_mask_lo_res).ravel()).unique())
         if unique_values != expected_quantization:
             raise ValueError('Masks arrays not quantized to the set {0, 1}. Did you pass is_label=True?')
     else:
@@ -485,11 +752,12 @@ def k3d_plot(img, color_range=None):
     import numpy as np
         
     if color_range is None:
-        img_array = sitk.GetArrayFromImage(img).ravel()
+        img_array = sitk.GetArrayViewFromImage(img).ravel()
         color_range = [img_array.min(), img_array.max()]
 
     im_sitk = img
-    img  = sitk.GetArrayFromImage(im_sitk)
+    # Zero-copy view; the astype(np.float32) below makes the only copy needed.
+    img  = sitk.GetArrayViewFromImage(im_sitk)
     size = np.array(im_sitk.GetSize()) * np.array(im_sitk.GetSpacing())
     im_sitk.GetSize()
 
@@ -524,25 +792,32 @@ def animate_2d_plot(sitk_image, repeat=True):
     fig = plt.figure()
     imgs = []
 
+    # One zero-copy view of the whole volume, sliced with NumPy per frame,
+    # instead of a SimpleITK slice per frame. The view is in (z, y, x)
+    # order, the reverse of sitk's (x, y, z) indexing. Each frame copies
+    # its 2D slice (np.array) because the returned ArtistAnimation reads
+    # the arrays at draw time, when the view's buffer may be gone.
+    vol = sitk.GetArrayViewFromImage(sitk_image)
+
     shape = sitk_image.GetSize()
     for m in range(0, 3):
-        
+
         step = shape[m] // 8
         for l in range(0, shape[m], step):
             if m == 2:
                 i = l
                 j = k = 0
-                img = plt.imshow(sitk.GetArrayFromImage(sitk_image[i,:,:]), animated=True)
+                img = plt.imshow(np.array(vol[:, :, i]), animated=True)
                 text = f'Y vs. Z @ x = {i:3n}  [{i:2n}, :, :]'
             elif m == 1:
                 j = l
                 i = k = 0
-                img = plt.imshow(sitk.GetArrayFromImage(sitk_image[:,j,:]), animated=True)
+                img = plt.imshow(np.array(vol[:, j, :]), animated=True)
                 text = f'X vs. Z @ y = {j:3n}  [:, {j:2n}, :]'
             elif m == 0:
                 k = l
                 i = j = 0
-                img = plt.imshow(sitk.GetArrayFromImage(sitk_image[:,:,k]), animated=True)
+                img = plt.imshow(np.array(vol[k, :, :]), animated=True)
                 text = f'X vs. Y @ z = {k:3n}  [:, :, {k:2n}]'
 
             #img = plt.imshow(sitk.GetArrayFromImage(sample_mask[i,:,:]), animated=True)
@@ -558,6 +833,10 @@ def animate_2d_plot(sitk_image, repeat=True):
 
 def imshow_sitk(img):
     import matplotlib.pyplot as plt
+    # GetArrayFromImage (copying) on purpose: matplotlib keeps the array
+    # uncopied and reads it at draw time, after any temporary image passed
+    # in (e.g. a slice) has been garbage-collected. A zero-copy view would
+    # dangle.
     return plt.imshow(sitk.GetArrayFromImage(img))
 
 def interact_sitk_helper(img, x0, x1, y0, y1, x):